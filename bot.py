@@ -1,7 +1,11 @@
 import os
+import asyncio
 import logging
 import json
 import re
+import hashlib
+import sqlite3
+import threading
 from datetime import datetime
 from io import BytesIO
 import tempfile
@@ -9,7 +13,8 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler
 from google.cloud import vision
 from google.oauth2 import service_account
-import pandas as pd
+from PIL import Image
+import xlsxwriter
 
 # Configuration du logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -18,6 +23,12 @@ logger = logging.getLogger(__name__)
 # Configuration
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 GOOGLE_CREDENTIALS_JSON = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+# URL publique du bot : si définie, le bot reçoit les mises à jour par
+# webhook sur PORT au lieu de faire du polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+PORT = int(os.getenv('PORT', 8443))
+# Fichier SQLite des frais (à placer sur un volume persistant en production)
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'frais.db')
 
 # Catégories de frais
 CATEGORIES = [
@@ -30,50 +41,165 @@ CATEGORIES = [
     "Autres"
 ]
 
-# Structure de données des frais (simulé avec stockage en mémoire)
-# En production, utiliser une vraie base de données
-frais_data = []
+def build_categories_keyboard():
+    """Construit le clavier des catégories (2 boutons par ligne)"""
+    keyboard = []
+    for i in range(0, len(CATEGORIES), 2):
+        row = []
+        row.append(InlineKeyboardButton(CATEGORIES[i], callback_data=f"cat_{i}"))
+        if i + 1 < len(CATEGORIES):
+            row.append(InlineKeyboardButton(CATEGORIES[i+1], callback_data=f"cat_{i+1}"))
+        keyboard.append(row)
+    return InlineKeyboardMarkup(keyboard)
+
+# Clavier construit une seule fois (les objets telegram sont immuables)
+CATEGORIES_KEYBOARD = build_categories_keyboard()
+
+# Expressions régulières de parsing des tickets (compilées une seule fois)
+MONTANT_PATTERNS = [
+    re.compile(r'(\d+[.,]\d{2})\s*€', re.IGNORECASE),
+    re.compile(r'€\s*(\d+[.,]\d{2})', re.IGNORECASE),
+    re.compile(r'total[:\s]+(\d+[.,]\d{2})', re.IGNORECASE),
+    re.compile(r'(\d+[.,]\d{2})\s*eur', re.IGNORECASE),
+]
+DATE_PATTERNS = [
+    re.compile(r'(\d{2})[/-](\d{2})[/-](\d{4})'),
+    re.compile(r'(\d{2})[/-](\d{2})[/-](\d{2})'),
+]
+
+# Montant saisi manuellement (ex: 15.50, 15,5, 15, ,5)
+MONTANT_MANUEL_PATTERN = re.compile(r'\s*(?:\d*[.,]\d+|\d+(?:[.,]\d*)?)\s*')
 
-# Client Google Vision
+# Base de données des frais (connexion SQLite)
+# mois/annee sont extraits de la date à l'insertion pour filtrer sur index
+# sans reparser les chaînes
+db = None
+
+# Client Google Vision (et credentials parsés, réutilisés si l'initialisation
+# doit être relancée)
 vision_client = None
+credentials_info = None
+vision_client_lock = threading.Lock()
+
+# Taille max (px) du plus grand côté des images envoyées à Vision : au-delà,
+# la précision OCR n'augmente plus mais l'envoi est plus long
+OCR_MAX_DIMENSION = 1600
+
+# Contexte OCR : tickets en français
+OCR_IMAGE_CONTEXT = vision.ImageContext(language_hints=['fr'])
+
+# Cache OCR : empreinte de l'image -> texte extrait (évite un appel Vision
+# quand la même photo est renvoyée). Protégé par un verrou : l'OCR tourne
+# dans des threads
+OCR_CACHE_MAX = 1024
+ocr_cache = {}
+ocr_cache_lock = threading.Lock()
+
+def init_database():
+    """Ouvre la base SQLite et crée la table des frais si besoin"""
+    global db
+    db = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS frais (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT NOT NULL,
+            mois INTEGER NOT NULL,
+            annee INTEGER NOT NULL,
+            montant REAL NOT NULL,
+            categorie TEXT NOT NULL,
+            timestamp TEXT NOT NULL
+        )
+    """)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_frais_annee_mois ON frais (annee, mois)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_frais_categorie ON frais (categorie)")
+    db.commit()
+    logger.info(f"Base de données ouverte : {DATABASE_PATH}")
 
 def init_vision_client():
-    """Initialise le client Google Vision"""
-    global vision_client
-    try:
-        if not GOOGLE_CREDENTIALS_JSON:
-            logger.error("GOOGLE_APPLICATION_CREDENTIALS vide!")
+    """Initialise le client Google Vision (sans effet s'il l'est déjà)"""
+    global vision_client, credentials_info
+    if vision_client is not None:
+        return
+    
+    # Un seul thread initialise le client, les autres attendent puis le réutilisent
+    with vision_client_lock:
+        if vision_client is not None:
             return
         
-        # Charger les credentials depuis le JSON en variable d'environnement
-        logger.info("Chargement des credentials Google Vision...")
-        credentials_info = json.loads(GOOGLE_CREDENTIALS_JSON)
-        credentials = service_account.Credentials.from_service_account_info(credentials_info)
-        vision_client = vision.ImageAnnotatorClient(credentials=credentials)
-        logger.info("Google Vision initialisé avec succès ✓")
-    except json.JSONDecodeError as e:
-        logger.error(f"Erreur parsing JSON credentials: {e}")
-    except Exception as e:
-        logger.error(f"Erreur initialisation Google Vision: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
+        try:
+            if not GOOGLE_CREDENTIALS_JSON:
+                logger.error("GOOGLE_APPLICATION_CREDENTIALS vide!")
+                return
+            
+            # Charger les credentials depuis le JSON en variable d'environnement
+            logger.info("Chargement des credentials Google Vision...")
+            if credentials_info is None:
+                credentials_info = json.loads(GOOGLE_CREDENTIALS_JSON)
+            credentials = service_account.Credentials.from_service_account_info(credentials_info)
+            vision_client = vision.ImageAnnotatorClient(credentials=credentials)
+            logger.info("Google Vision initialisé avec succès ✓")
+        except json.JSONDecodeError as e:
+            logger.error(f"Erreur parsing JSON credentials: {e}")
+        except Exception as e:
+            logger.error(f"Erreur initialisation Google Vision: {e}")
+            import traceback
+            logger.error(traceback.format_exc())
+
+def reduire_image(image_bytes):
+    """Réduit l'image à OCR_MAX_DIMENSION px de côté (JPEG) si elle est plus grande"""
+    image = Image.open(BytesIO(image_bytes))
+    if max(image.size) <= OCR_MAX_DIMENSION:
+        return image_bytes
+    
+    image.thumbnail((OCR_MAX_DIMENSION, OCR_MAX_DIMENSION), Image.Resampling.LANCZOS)
+    output = BytesIO()
+    image.convert('RGB').save(output, format='JPEG', quality=85, optimize=True)
+    return output.getvalue()
 
 def extract_text_from_image(image_bytes):
-    """Extrait le texte d'une image avec Google Vision OCR"""
+    """Extrait le texte d'une image avec Google Vision OCR (appel bloquant,
+    à exécuter hors de la boucle asyncio)"""
+    empreinte = hashlib.blake2b(image_bytes, digest_size=16).digest()
+    with ocr_cache_lock:
+        text = ocr_cache.pop(empreinte, None)
+        if text is not None:
+            # Remettre en fin de dict : les plus anciens sont évincés en premier
+            ocr_cache[empreinte] = text
+            return text
+    
+    # Relancer l'initialisation si elle a échoué au démarrage
+    init_vision_client()
+    
     try:
-        image = vision.Image(content=image_bytes)
-        response = vision_client.text_detection(image=image)
-        texts = response.text_annotations
-        
-        if texts:
-            return texts[0].description
-        return None
+        image = vision.Image(content=reduire_image(image_bytes))
+        # Détection de texte dense, adaptée aux tickets imprimés
+        response = vision_client.document_text_detection(
+            image=image, image_context=OCR_IMAGE_CONTEXT
+        )
     except Exception as e:
         logger.error(f"Erreur OCR: {e}")
         return None
+    
+    text = response.full_text_annotation.text
+    if not text:
+        return None
+    
+    with ocr_cache_lock:
+        ocr_cache[empreinte] = text
+        if len(ocr_cache) > OCR_CACHE_MAX:
+            ocr_cache.pop(next(iter(ocr_cache)))
+    return text
 
 def parse_ticket_info(text):
-    """Parse les informations du ticket (montant, date)"""
+    """Parse les informations du ticket (montant, date)
+
+    >>> parse_ticket_info('12/05/2024\\nTOTAL: 23,40€\\nTVA 10% 2,13€')['montant']
+    23.4
+    >>> parse_ticket_info('01/02/03/04/2024')['date']
+    '03/04/2024'
+    """
     info = {
         'montant': None,
         'date': None,
@@ -81,28 +207,16 @@ def parse_ticket_info(text):
     }
     
     # Recherche du montant (formats: 12.50€, 12,50€, 12.50, €12.50)
-    montant_patterns = [
-        r'(\d+[.,]\d{2})\s*€',
-        r'€\s*(\d+[.,]\d{2})',
-        r'total[:\s]+(\d+[.,]\d{2})',
-        r'(\d+[.,]\d{2})\s*eur',
-    ]
-    
-    for pattern in montant_patterns:
-        match = re.search(pattern, text.lower())
+    for pattern in MONTANT_PATTERNS:
+        match = pattern.search(text)
         if match:
             montant_str = match.group(1).replace(',', '.')
             info['montant'] = float(montant_str)
             break
     
     # Recherche de la date (formats: JJ/MM/AAAA, JJ-MM-AAAA, etc.)
-    date_patterns = [
-        r'(\d{2})[/-](\d{2})[/-](\d{4})',
-        r'(\d{2})[/-](\d{2})[/-](\d{2})',
-    ]
-    
-    for pattern in date_patterns:
-        match = re.search(pattern, text)
+    for pattern in DATE_PATTERNS:
+        match = pattern.search(text)
         if match:
             try:
                 jour, mois, annee = match.groups()
@@ -192,11 +306,14 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         photo = update.message.photo[-1]
         file = await context.bot.get_file(photo.file_id)
         
-        # Télécharger l'image
-        image_bytes = await file.download_as_bytearray()
+        # Télécharger l'image (getvalue() ne recopie pas le buffer)
+        buffer = BytesIO()
+        await file.download_to_memory(buffer)
+        image_bytes = buffer.getvalue()
         
-        # OCR avec Google Vision
-        text = extract_text_from_image(bytes(image_bytes))
+        # OCR avec Google Vision, dans un thread pour ne pas bloquer les
+        # autres mises à jour pendant l'appel réseau
+        text = await asyncio.to_thread(extract_text_from_image, image_bytes)
         
         if not text:
             await update.message.reply_text(
@@ -210,17 +327,6 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Stocker temporairement dans le contexte
         context.user_data['pending_frais'] = info
         
-        # Créer les boutons de catégories
-        keyboard = []
-        for i in range(0, len(CATEGORIES), 2):
-            row = []
-            row.append(InlineKeyboardButton(CATEGORIES[i], callback_data=f"cat_{i}"))
-            if i + 1 < len(CATEGORIES):
-                row.append(InlineKeyboardButton(CATEGORIES[i+1], callback_data=f"cat_{i+1}"))
-            keyboard.append(row)
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         # Message de confirmation
         msg = f"✅ *Ticket analysé !*\n\n"
         if info['montant']:
@@ -230,7 +336,7 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg += f"📅 Date : {info['date']}\n\n"
         msg += "Choisis la catégorie :"
         
-        await update.message.reply_text(msg, reply_markup=reply_markup, parse_mode='Markdown')
+        await update.message.reply_text(msg, reply_markup=CATEGORIES_KEYBOARD, parse_mode='Markdown')
         
     except Exception as e:
         logger.error(f"Erreur traitement photo: {e}")
@@ -241,20 +347,24 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_category_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Gère la sélection de catégorie"""
     query = update.callback_query
-    await query.answer()
     
     # Récupérer l'index de catégorie
     cat_index = int(query.data.split('_')[1])
     categorie = CATEGORIES[cat_index]
     
-    # Récupérer les infos temporaires
-    pending = context.user_data.get('pending_frais')
+    # Retirer les infos temporaires avant tout await : les mises à jour étant
+    # traitées en parallèle, un double clic ne doit enregistrer qu'un frais
+    pending = context.user_data.pop('pending_frais', None)
+    
+    await query.answer()
+    
     if not pending:
         await query.edit_message_text("❌ Session expirée. Renvoie la photo du ticket.")
         return
     
     # Si montant non détecté, demander à l'utilisateur
     if not pending['montant']:
+        context.user_data['pending_frais'] = pending
         context.user_data['pending_category'] = categorie
         await query.edit_message_text(
             f"💰 Je n'ai pas détecté le montant.\nEnvoie-le moi (exemple: 15.50)"
@@ -262,181 +372,203 @@ async def handle_category_selection(update: Update, context: ContextTypes.DEFAUL
         return
     
     # Enregistrer le frais
-    frais = {
-        'id': len(frais_data) + 1,
-        'date': pending['date'],
-        'montant': pending['montant'],
-        'categorie': categorie,
-        'timestamp': datetime.now().isoformat()
-    }
-    
-    frais_data.append(frais)
+    now = datetime.now()
+    frais = enregistrer_frais(pending['date'], pending['montant'], categorie, now)
     
     # Confirmation
-    msg = f"✅ *Frais enregistré !*\n\n"
-    msg += f"📁 Catégorie : {categorie}\n"
-    msg += f"💰 Montant : {frais['montant']:.2f}€\n"
-    msg += f"📅 Date : {frais['date']}\n\n"
-    msg += f"_Total ce mois : {get_total_mois():.2f}€_"
-    
-    await query.edit_message_text(msg, parse_mode='Markdown')
-    
-    # Nettoyer les données temporaires
-    context.user_data.pop('pending_frais', None)
+    await query.edit_message_text(message_confirmation(frais, now), parse_mode='Markdown')
 
 async def handle_montant_manuel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Gère la saisie manuelle du montant"""
     if 'pending_category' not in context.user_data:
         return
     
-    try:
-        montant = float(update.message.text.replace(',', '.'))
-        pending = context.user_data.get('pending_frais')
-        categorie = context.user_data.get('pending_category')
-        
-        frais = {
-            'id': len(frais_data) + 1,
-            'date': pending['date'],
-            'montant': montant,
-            'categorie': categorie,
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        frais_data.append(frais)
-        
-        msg = f"✅ *Frais enregistré !*\n\n"
-        msg += f"📁 Catégorie : {categorie}\n"
-        msg += f"💰 Montant : {montant:.2f}€\n"
-        msg += f"📅 Date : {frais['date']}\n\n"
-        msg += f"_Total ce mois : {get_total_mois():.2f}€_"
-        
-        await update.message.reply_text(msg, parse_mode='Markdown')
-        
-        context.user_data.pop('pending_frais', None)
-        context.user_data.pop('pending_category', None)
-        
-    except ValueError:
+    if not MONTANT_MANUEL_PATTERN.fullmatch(update.message.text):
         await update.message.reply_text("❌ Montant invalide. Utilise le format: 15.50")
+        return
+    
+    # Retirer les infos temporaires avant tout await : un montant envoyé deux
+    # fois (mises à jour traitées en parallèle) n'enregistre qu'un frais
+    pending = context.user_data.pop('pending_frais', None)
+    categorie = context.user_data.pop('pending_category', None)
+    if not pending or not categorie:
+        return
+    
+    montant = float(update.message.text.replace(',', '.'))
+    now = datetime.now()
+    frais = enregistrer_frais(pending['date'], montant, categorie, now)
+    
+    await update.message.reply_text(message_confirmation(frais, now), parse_mode='Markdown')
 
-def get_total_mois():
-    """Calcule le total des frais du mois en cours"""
-    mois_actuel = datetime.now().strftime("%m/%Y")
-    total = sum(f['montant'] for f in frais_data if f['date'].endswith(mois_actuel))
-    return total
+def enregistrer_frais(date, montant, categorie, now):
+    """Ajoute un frais (date au format JJ/MM/AAAA) horodaté à `now` et le retourne"""
+    frais = {
+        'date': date,
+        'mois': int(date[3:5]),
+        'annee': int(date[6:10]),
+        'montant': montant,
+        'categorie': categorie,
+        'timestamp': now.isoformat()
+    }
+    with db:
+        cursor = db.execute(
+            "INSERT INTO frais (date, mois, annee, montant, categorie, timestamp) "
+            "VALUES (:date, :mois, :annee, :montant, :categorie, :timestamp)",
+            frais
+        )
+    frais['id'] = cursor.lastrowid
+    return frais
+
+def message_confirmation(frais, now):
+    """Message de confirmation d'un frais enregistré"""
+    return (
+        f"✅ *Frais enregistré !*\n\n"
+        f"📁 Catégorie : {frais['categorie']}\n"
+        f"💰 Montant : {frais['montant']:.2f}€\n"
+        f"📅 Date : {frais['date']}\n\n"
+        f"_Total ce mois : {get_total_mois(now):.2f}€_"
+    )
+
+def get_total_mois(now):
+    """Calcule le total des frais du mois de `now`"""
+    row = db.execute(
+        "SELECT COALESCE(SUM(montant), 0) FROM frais WHERE annee = ? AND mois = ?",
+        (now.year, now.month)
+    ).fetchone()
+    return row[0]
 
 async def recap_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Commande /recap pour voir le récapitulatif"""
+    now = datetime.now()
+    annee = now.year
     if len(context.args) > 0:
-        mois = context.args[0].zfill(2)
-        annee = datetime.now().year
-        filtre = f"{mois}/{annee}"
+        try:
+            mois = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("❌ Mois invalide")
+            return
     else:
-        filtre = datetime.now().strftime("%m/%Y")
+        mois = now.month
+    filtre = f"{mois:02d}/{annee}"
     
-    frais_mois = [f for f in frais_data if f['date'].endswith(filtre)]
+    # Grouper par catégorie (triées par nom)
+    par_categorie = db.execute(
+        "SELECT categorie, SUM(montant), COUNT(*) FROM frais "
+        "WHERE annee = ? AND mois = ? GROUP BY categorie ORDER BY categorie",
+        (annee, mois)
+    ).fetchall()
     
-    if not frais_mois:
+    if not par_categorie:
         await update.message.reply_text(f"Aucun frais enregistré pour {filtre}")
         return
     
-    msg = f"📊 *Récapitulatif {filtre}*\n\n"
-    
-    # Grouper par catégorie
-    par_categorie = {}
-    for frais in frais_mois:
-        cat = frais['categorie']
-        if cat not in par_categorie:
-            par_categorie[cat] = []
-        par_categorie[cat].append(frais)
+    parts = [f"📊 *Récapitulatif {filtre}*\n\n"]
     
-    # Trier par catégorie et afficher
-    for cat in sorted(par_categorie.keys()):
-        items = par_categorie[cat]
-        total_cat = sum(f['montant'] for f in items)
-        msg += f"*{cat}* : {total_cat:.2f}€ ({len(items)} ticket{'s' if len(items) > 1 else ''})\n"
+    for cat, total_cat, nb in par_categorie:
+        parts.append(f"*{cat}* : {total_cat:.2f}€ ({nb} ticket{'s' if nb > 1 else ''})\n")
     
-    total = sum(f['montant'] for f in frais_mois)
-    msg += f"\n💰 *TOTAL : {total:.2f}€*"
+    total = sum(total_cat for _, total_cat, _ in par_categorie)
+    parts.append(f"\n💰 *TOTAL : {total:.2f}€*")
     
-    await update.message.reply_text(msg, parse_mode='Markdown')
+    await update.message.reply_text("".join(parts), parse_mode='Markdown')
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Commande /stats pour les statistiques"""
-    if not frais_data:
+    par_categorie = db.execute(
+        "SELECT categorie, SUM(montant) AS montant FROM frais "
+        "GROUP BY categorie ORDER BY montant DESC"
+    ).fetchall()
+    
+    if not par_categorie:
         await update.message.reply_text("Aucun frais enregistré pour le moment.")
         return
     
-    msg = "📈 *Statistiques par catégorie*\n\n"
-    
-    par_categorie = {}
-    for frais in frais_data:
-        cat = frais['categorie']
-        par_categorie[cat] = par_categorie.get(cat, 0) + frais['montant']
+    parts = ["📈 *Statistiques par catégorie*\n\n"]
     
-    total_general = sum(par_categorie.values())
+    total_general = sum(montant for _, montant in par_categorie)
     
-    for cat, montant in sorted(par_categorie.items(), key=lambda x: x[1], reverse=True):
+    for cat, montant in par_categorie:
         pourcentage = (montant / total_general * 100) if total_general > 0 else 0
-        msg += f"• {cat}: {montant:.2f}€ ({pourcentage:.1f}%)\n"
+        parts.append(f"• {cat}: {montant:.2f}€ ({pourcentage:.1f}%)\n")
     
-    msg += f"\n💰 Total : {total_general:.2f}€"
+    parts.append(f"\n💰 Total : {total_general:.2f}€")
     
-    await update.message.reply_text(msg, parse_mode='Markdown')
+    await update.message.reply_text("".join(parts), parse_mode='Markdown')
 
 async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Commande /export pour générer l'Excel"""
-    if not frais_data:
-        await update.message.reply_text("Aucun frais à exporter.")
-        return
-    
-    await update.message.reply_text("📄 Génération de l'Excel en cours...")
-    
     # Filtrer par année si spécifié
     if len(context.args) > 0:
-        annee = context.args[0]
-        data_export = [f for f in frais_data if f['date'].endswith(annee)]
+        try:
+            annee = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("❌ Année invalide")
+            return
+        filtre = "annee = ?"
+        params = (annee,)
         filename = f"frais_pro_{annee}.xlsx"
     else:
-        mois_actuel = datetime.now().strftime("%m/%Y")
-        data_export = [f for f in frais_data if f['date'].endswith(mois_actuel)]
-        filename = f"frais_pro_{datetime.now().strftime('%m_%Y')}.xlsx"
+        now = datetime.now()
+        filtre = "annee = ? AND mois = ?"
+        params = (now.year, now.month)
+        filename = f"frais_pro_{now.strftime('%m_%Y')}.xlsx"
     
-    # Créer le DataFrame
-    df = pd.DataFrame(data_export)
-    df = df[['date', 'categorie', 'montant']]
-    df.columns = ['Date', 'Catégorie', 'Montant (€)']
+    existe = db.execute(f"SELECT 1 FROM frais WHERE {filtre} LIMIT 1", params).fetchone()
     
-    # Ajouter une ligne de total
-    total_row = pd.DataFrame([['', 'TOTAL', df['Montant (€)'].sum()]], 
-                            columns=df.columns)
-    df = pd.concat([df, total_row], ignore_index=True)
+    if not existe:
+        await update.message.reply_text("Aucun frais à exporter.")
+        return
     
-    # Sauvegarder en Excel
+    await update.message.reply_text("📄 Génération de l'Excel en cours...")
+    
+    # Sauvegarder en Excel ligne par ligne depuis le curseur (constant_memory :
+    # une seule ligne gardée en mémoire). Nombre et total sont calculés sur les
+    # lignes écrites : des frais ont pu être ajoutés pendant l'await ci-dessus
     output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Frais professionnels')
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Frais professionnels')
+    worksheet.write_row(0, 0, ['Date', 'Catégorie', 'Montant (€)'], workbook.add_format({'bold': True}))
+    cursor = db.execute(
+        f"SELECT date, categorie, montant FROM frais WHERE {filtre} ORDER BY id", params
+    )
+    nb_frais = 0
+    total = 0
+    for row in cursor:
+        nb_frais += 1
+        total += row['montant']
+        worksheet.write_row(nb_frais, 0, row)
+    
+    # Ajouter une ligne de total
+    worksheet.write_row(nb_frais + 1, 0, ['', 'TOTAL', total])
+    workbook.close()
     
     output.seek(0)
     
     await update.message.reply_document(
         document=output,
         filename=filename,
-        caption=f"📊 Export Excel - {len(data_export)} frais - Total: {df['Montant (€)'].iloc[-1]:.2f}€"
+        caption=f"📊 Export Excel - {nb_frais} frais - Total: {total:.2f}€"
     )
 
 async def liste_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Commande /liste pour voir tous les frais avec ID"""
-    if not frais_data:
+    # Derniers 20, du plus ancien au plus récent, lus depuis le curseur
+    cursor = db.execute(
+        "SELECT * FROM (SELECT id, date, categorie, montant FROM frais "
+        "ORDER BY id DESC LIMIT 20) ORDER BY id"
+    )
+    
+    parts = ["📋 *Liste des frais*\n\n"]
+    for frais in cursor:
+        parts.append(f"#{frais['id']} - {frais['date']} - {frais['categorie']} - {frais['montant']:.2f}€\n")
+    
+    if len(parts) == 1:
         await update.message.reply_text("Aucun frais enregistré.")
         return
     
-    msg = "📋 *Liste des frais*\n\n"
-    for frais in frais_data[-20:]:  # Derniers 20
-        msg += f"#{frais['id']} - {frais['date']} - {frais['categorie']} - {frais['montant']:.2f}€\n"
+    parts.append("\n_Utilise /supprimer ID pour supprimer un frais_")
     
-    msg += f"\n_Utilise /supprimer ID pour supprimer un frais_"
-    
-    await update.message.reply_text(msg, parse_mode='Markdown')
+    await update.message.reply_text("".join(parts), parse_mode='Markdown')
 
 async def supprimer_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Commande /supprimer pour supprimer un frais"""
@@ -446,10 +578,10 @@ async def supprimer_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         frais_id = int(context.args[0])
-        frais_to_remove = next((f for f in frais_data if f['id'] == frais_id), None)
+        with db:
+            cursor = db.execute("DELETE FROM frais WHERE id = ?", (frais_id,))
         
-        if frais_to_remove:
-            frais_data.remove(frais_to_remove)
+        if cursor.rowcount:
             await update.message.reply_text(f"✅ Frais #{frais_id} supprimé")
         else:
             await update.message.reply_text(f"❌ Frais #{frais_id} introuvable")
@@ -462,11 +594,15 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 def main():
     """Fonction principale"""
+    # Ouvrir la base de données
+    init_database()
+    
     # Initialiser Google Vision
     init_vision_client()
     
-    # Créer l'application
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Créer l'application (mises à jour traitées en parallèle : l'OCR d'un
+    # ticket ne bloque pas les autres utilisateurs)
+    application = Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(True).build()
     
     # Handlers
     application.add_handler(CommandHandler("start", start))
@@ -483,7 +619,16 @@ def main():
     application.add_error_handler(error_handler)
     
     logger.info("Bot Frais Pro démarré!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen='0.0.0.0',
+            port=PORT,
+            url_path=TELEGRAM_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_TOKEN}",
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()